@@ -1,6 +1,13 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from .cdk_changeset_reporter import CdkChangesetReporter
 
+
+def positive_int(value: str) -> int:
+    if not value.isdigit() or int(value) < 1:
+        raise ArgumentTypeError(f"must be a positive integer, got {value!r}")
+    return int(value)
+
+
 parser = ArgumentParser(
     prog="cdk_changeset_reporter",
     description="Pretty prints the CFN changesets of CloudAssembly stacks",
@@ -24,10 +31,17 @@ parser.add_argument(
 parser.add_argument(
     "-s",
     "--stacks",
-    default="*",
+    default=["*"],
     nargs="+",
     help="Cloud Assembly stack selector. Accepts exact stack names, prefixes or '*' ( the default )",
 )
+parser.add_argument(
+    "-w",
+    "--max_workers",
+    type=positive_int,
+    default=10,
+    help="Number of stacks queried concurrently",
+)
 
 parser.add_argument(
     "--level",
@@ -44,10 +58,9 @@ if __name__ == "__main__":
         cloud_assembly_dir=args.app,
         change_set_name=args.change_set_name,
         log_level=args.level,
+        max_workers=args.max_workers,
     )
-    stack_selectors = ["*"] if "*" in args.stacks else args.stacks
-    for selector in stack_selectors:
-        reporter.add_stacks(selector)
+    reporter.add_stacks_many(args.stacks)
 
     changes = reporter.gather_changes()
     reporter.report(changes)
@@ -1,11 +1,67 @@
-from typing import NamedTuple
+from typing import Callable, Iterable, NamedTuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import functools
+import random
+import time
 import aws_cdk.cx_api as cx_api
 import botocore
+import botocore.config
+import botocore.credentials
 import boto3
 import datetime
 from dateutil.tz import tzlocal
-from terminaltables import GithubFlavoredMarkdownTable as Table
 import logging
+import os
+import re
+import sys
+
+# Shared with the AWS CLI, so credentials assumed by either tool are reused until expiry
+CREDENTIAL_CACHE_DIR = os.path.expanduser(os.path.join("~", ".aws", "cli", "cache"))
+
+# Adaptive mode rate-limits the client side when CFN starts throttling the fan-out.
+# TCP keepalive probes detect pooled connections that died while idle.
+CFN_CLIENT_CONFIG = botocore.config.Config(
+    retries={"max_attempts": 10, "mode": "adaptive"},
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+)
+# Pseudo parameter placeholders in the lookup role ARNs of the assembly manifest
+_ARN_PLACEHOLDER_RE = re.compile(r"\$\{AWS::(Partition|AccountId|Region)\}")
+# Random pause between batches of stack queries, in seconds
+BATCH_DELAY = (0.5, 1.5)
+
+
+@functools.lru_cache
+def _truncated_half_length(max_length: int) -> int:
+    # Length kept on either side of the "(...)" marker
+    return max(int(max_length / 2 - 2.5), 0)
+
+
+def truncate(max_length: int, text: str) -> str:
+    if len(text) <= max_length:
+        return text
+    half = _truncated_half_length(max_length)
+    # Not text[-half:], which is the whole string when half is 0
+    return text[:half] + "(...)" + text[len(text) - half :]
+
+
+class CredentialFileCache(botocore.credentials.JSONFileCache):
+    """
+    JSONFileCache that keeps going without persisting the credentials when the cache dir can't be written to,
+    e.g. a read-only HOME in a CI container.
+    """
+
+    def __init__(self, working_dir: str, logger: logging.Logger) -> None:
+        super().__init__(working_dir)
+        self.logger = logger
+
+    def __setitem__(self, cache_key, value):
+        try:
+            super().__setitem__(cache_key, value)
+        except OSError as e:
+            self.logger.debug(f"Not caching credentials: {e}")
 
 
 class StackInfo(NamedTuple):
@@ -27,6 +83,8 @@ class CdkChangesetReporter:
         reporter.add_stacks("base")
         # to select all stacks in the cloud assembly:
         # reporter.add_stacks("*")
+        # or several selectors in one pass over the cloud assembly:
+        # reporter.add_stacks_many(["staging", "base"])
         changes = reporter.gather_changes()
         reporter.report(changes)
 
@@ -42,60 +100,149 @@ class CdkChangesetReporter:
         change_set_name: str,
         cloud_assembly_dir: str = "cdk.out",
         log_level: str = "INFO",
+        max_workers: int = 10,
     ) -> None:
         """
 
         :param change_set_name: The name of the Cloudformation changeset to look for
         :param cloud_assembly_dir: Path to the Cloud Assembly dir, defaults to "cdk.out"
         :param log_level: Log level, defaults to INFO
+        :param max_workers: Number of stacks queried concurrently, defaults to 10
         """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(log_level)
         logging.basicConfig()
 
         self.change_set_name = change_set_name
+        self.max_workers = max_workers
+        # Sessions are keyed on role ARN and clients on (role ARN, region), so stacks
+        # sharing a lookup role only trigger a single AssumeRole call
+        self._session_cache: dict[str, boto3.Session] = {}
+        self._client_cache: dict[tuple[str, str], object] = {}
+        self._cache_lock = threading.Lock()
+        # Source of the credentials used to assume each lookup role. Shared so the source
+        # credential chain is only resolved once; each role still gets its own session.
+        self._base_session = boto3.session.Session()._session
+        self._base_session_lock = threading.Lock()
+        self.cloud_assembly_dir = cloud_assembly_dir
+        self._stack_infos: dict[str, StackInfo | None] = {}
         self.reset_stack_selection()
-        self.cloud_assembly = cx_api.CloudAssembly(
-            cloud_assembly_dir,
+
+    @functools.cached_property
+    def cloud_assembly(self) -> cx_api.CloudAssembly:
+        # Loaded on first use, as reading the manifest through JSII is slow
+        return cx_api.CloudAssembly(
+            self.cloud_assembly_dir,
             topo_sort=True,
         )
 
     def reset_stack_selection(self):
-        self.stacks = set()
+        # Keyed on stack name, which dedupes stacks matched by several selectors
+        # and keeps them in insertion (assembly) order
+        self.stacks: dict[str, StackInfo] = {}
+
+    @functools.cached_property
+    def _assembly_stacks(
+        self,
+    ) -> list[tuple[str, cx_api.CloudFormationStackArtifact]]:
+        # Only the names are read up front, as every attribute access goes through the
+        # JSII bridge. The rest is resolved for the selected stacks only.
+        return [(s.stack_name, s) for s in self.cloud_assembly.stacks_recursively]
+
+    def _stack_info(
+        self, name: str, stack: cx_api.CloudFormationStackArtifact
+    ) -> StackInfo | None:
+        if name not in self._stack_infos:
+            self._stack_infos[name] = self._resolve_stack_info(name, stack)
+        return self._stack_infos[name]
+
+    def _resolve_stack_info(
+        self, name: str, stack: cx_api.CloudFormationStackArtifact
+    ) -> StackInfo | None:
+        lookup_role = stack.lookup_role
+        # e.g. stacks synthesized with the legacy or CLI credentials synthesizers
+        if lookup_role is None:
+            self.logger.warn(f"Skipping stack {name}: it has no lookup role")
+            return None
+        environment = stack.environment
+        subs = {
+            "Partition": "aws",
+            "AccountId": environment.account,
+            "Region": environment.region,
+        }
+        return StackInfo(
+            name=name,
+            role_arn=_ARN_PLACEHOLDER_RE.sub(
+                lambda m: subs[m.group(1)], lookup_role.arn
+            ),
+            region=subs["Region"],
+        )
+
+    def _select_stacks(self, include: Callable[[str], bool]) -> list[StackInfo]:
+        result = []
+        for name, stack in self._assembly_stacks:
+            if include(name):
+                stack_info = self._stack_info(name, stack)
+                if stack_info:
+                    result.append(stack_info)
+        return result
 
     def add_stacks(
         self,
         stack_selector: str,
     ) -> None:
-        def _should_be_included(s: cx_api.CloudFormationStackArtifact) -> bool:
-            return s.stack_name.startswith(stack_selector) or stack_selector == "*"
-
-        self.logger.debug(f"Selection: {stack_selector}")
-
-        result = [
-            StackInfo(
-                name=s.stack_name,
-                role_arn=s.lookup_role.arn.replace("${AWS::Partition}", "aws")
-                .replace("${AWS::AccountId}", s.environment.account)
-                .replace("${AWS::Region}", s.environment.region),
-                region=s.environment.region,
-            )
-            for s in self.cloud_assembly.stacks_recursively
-            if _should_be_included(s)
-        ]
+        self.add_stacks_many([stack_selector])
+
+    def add_stacks_many(self, stack_selectors: Iterable[str]) -> None:
+        """
+        Select the stacks matching any of the given selectors (exact names, prefixes or "*").
+        """
+        stack_selectors = list(stack_selectors)
+        if "*" not in stack_selectors:
+            self.add_stacks_starting_with_any(stack_selectors)
+            return
+
+        # Everything is selected, so there is nothing to filter
+        self.logger.debug(f"Selection: {stack_selectors}")
+        result = self._select_stacks(lambda name: True)
         if not result:
-            self.logger.warn(f"No stacks found using selector: {stack_selector}")
+            self.logger.warn("No stacks found using selector: *")
+        self.logger.debug(f"Result: {result}")
+        for s in result:
+            self.stacks[s.name] = s
+
+    def add_stacks_starting_with_any(self, prefixes: list[str]) -> None:
+        """
+        Select the stacks whose name starts with any of the given prefixes, in a single pass over the assembly.
+        """
+        # str.startswith matches against all the prefixes at once when given a tuple
+        matcher = tuple(prefixes)
+        self.logger.debug(f"Selection: {prefixes}")
+
+        result = self._select_stacks(lambda name: name.startswith(matcher))
+        for prefix in prefixes:
+            if not any(s.name.startswith(prefix) for s in result):
+                self.logger.warn(f"No stacks found using selector: {prefix}")
         self.logger.debug(f"Result: {result}")
-        self.stacks.update(result)
+        for s in result:
+            self.stacks[s.name] = s
 
     def assumed_role_session(
         self, role_arn: str, base_session: botocore.session.Session = None
     ):
-        base_session = base_session or boto3.session.Session()._session
+        base_session = base_session or self._base_session
+
+        def create_client(*args, **kwargs):
+            # The STS clients are created from the worker threads when the deferred
+            # credentials are first refreshed, and sessions are not thread-safe
+            with self._base_session_lock:
+                return base_session.create_client(*args, **kwargs)
+
         fetcher = botocore.credentials.AssumeRoleCredentialFetcher(
-            client_creator=base_session.create_client,
+            client_creator=create_client,
             source_credentials=base_session.get_credentials(),
             role_arn=role_arn,
+            cache=CredentialFileCache(CREDENTIAL_CACHE_DIR, self.logger),
         )
         creds = botocore.credentials.DeferredRefreshableCredentials(
             method="assume-role",
@@ -106,118 +253,162 @@ class CdkChangesetReporter:
         botocore_session._credentials = creds
         return boto3.Session(botocore_session=botocore_session)
 
+    def cfn_client(self, role_arn: str, region: str):
+        # boto3 sessions are not thread-safe, so clients are only created under the lock.
+        # The clients themselves can be shared between the worker threads.
+        with self._cache_lock:
+            key = (role_arn, region)
+            if key not in self._client_cache:
+                if role_arn not in self._session_cache:
+                    self._session_cache[role_arn] = self.assumed_role_session(role_arn)
+                # Every worker may be using the same client, so size its pool to match
+                config = CFN_CLIENT_CONFIG.merge(
+                    botocore.config.Config(max_pool_connections=self.max_workers)
+                )
+                self._client_cache[key] = self._session_cache[role_arn].client(
+                    "cloudformation", region_name=region, config=config
+                )
+            return self._client_cache[key]
+
+    def _gather_one(self, stack: StackInfo) -> tuple[str, list] | None:
+        self.logger.debug(f"Query: {stack}")
+        cfn = self.cfn_client(role_arn=stack.role_arn, region=stack.region)
+        # TODO ensure only cdk-owned changesets?
+        pages = iter(
+            cfn.get_paginator("describe_change_set").paginate(
+                ChangeSetName=self.change_set_name, StackName=stack.name
+            )
+        )
+        try:
+            first_page = next(pages)
+        except cfn.exceptions.ChangeSetNotFoundException:
+            self.logger.debug(f"No changeset {self.change_set_name} for {stack.name}")
+            return None
+        if first_page["ExecutionStatus"] != "AVAILABLE":
+            return None
+        changes = first_page["Changes"]
+        # Large changesets are split over several pages
+        for page in pages:
+            changes.extend(page["Changes"])
+        return stack.name, changes
+
     def gather_changes(
         self,
     ) -> dict[str, dict]:
-        self.logger.debug(f"Assembly: {self.cloud_assembly.directory}")
+        self.logger.debug(f"Assembly: {self.cloud_assembly_dir}")
         self.logger.debug(f"Changeset: {self.change_set_name}")
 
-        changes = {}
-        for stack in self.stacks:
-            self.logger.debug(f"Query: {stack}")
-            session = self.assumed_role_session(role_arn=stack.role_arn)
-            cfn = session.client("cloudformation", region_name=stack.region)
-            change_sets = cfn.list_change_sets(StackName=stack.name)["Summaries"]
-            available_change_sets = [
-                # TODO ensure only cdk-owned changesets?
-                c
-                for c in change_sets
-                if c["ChangeSetName"] == self.change_set_name
-                and c["ExecutionStatus"] == "AVAILABLE"
-            ]
-            if available_change_sets:
-                changes[stack.name] = cfn.describe_change_set(
-                    ChangeSetName=available_change_sets[0]["ChangeSetName"],
-                    StackName=stack.name,
-                )["Changes"]
+        gathered = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            # Query the stacks one batch at a time, with a jittered delay in between, so a
+            # large selection doesn't hit the CFN API rate limits all at once. Each batch
+            # is collected before the next is submitted, so a failure stops the run early.
+            stacks = list(self.stacks.values())
+            for i in range(0, len(stacks), self.max_workers):
+                if i:
+                    time.sleep(random.uniform(*BATCH_DELAY))
+                batch = stacks[i : i + self.max_workers]
+                futures = [executor.submit(self._gather_one, s) for s in batch]
+                for future in as_completed(futures):
+                    result = future.result()
+                    if result:
+                        stack_name, stack_changes = result
+                        gathered[stack_name] = stack_changes
+        finally:
+            # Don't keep querying the rest of the batch if one of its stacks failed
+            executor.shutdown(wait=True, cancel_futures=True)
+        # Report in selection order rather than in the order the queries completed
+        changes = {name: gathered[name] for name in self.stacks if name in gathered}
         if not changes:
             self.logger.warn(f"No changesets matching {self.change_set_name} found")
         return changes
 
     def report(self, changes):
-        for stack_name, changes in changes.items():
-            print(self.generate_table(stack_name, changes))
+        # Written in one go rather than a print per stack
+        parts = [
+            self.generate_table(stack_name, stack_changes) + "\n"
+            for stack_name, stack_changes in changes.items()
+        ]
+        sys.stdout.write("".join(parts))
+        sys.stdout.flush()
 
     def gather_and_report(self, stack_selection: str):
         self.add_stacks(stack_selection)
         changes = self.gather_changes()
         self.report(changes)
 
-    def truncate(self, max_length: int, text: str) -> str:
-        if len(text) > max_length:
-            text = (
-                text[: int(max_length / 2 - 2.5)]
-                + "(...)"
-                + text[-int(max_length / 2 - 2.5) :]
-            )
-            return str(text)
-
     def generate_table(self, stack_name: str, reported_changes: dict):
         """
         Generate a table of the changes in the given stack.
         """
-        changes = []
+        # One list per column, so no intermediate row lists are built
+        actions, recreates, types, ids, targets, reasons = [], [], [], [], [], []
         recreate = False
         for change in reported_changes:
             # Extract the details
-            details = change["ResourceChange"]["Details"]
-            resource_id = change["ResourceChange"]["LogicalResourceId"]
+            resource_change = change["ResourceChange"]
+            details = resource_change["Details"]
+            resource_id = resource_change["LogicalResourceId"]
 
             # Truncate the resource ID if it's too long. Do this in the middle as
             # the important parts are at the beginning and end of the string
-            resource_id = self.truncate(50, resource_id)
+            resource_id = truncate(50, resource_id)
 
             # Some changes have no details
             if details:
-                change_target = details[0]["Target"].get("Name", "")
+                target = details[0]["Target"]
+                change_target = target.get("Name", "")
                 change_reason = details[0]["ChangeSource"]
-                requires_recreate = details[0]["Target"]["RequiresRecreation"]
+                requires_recreate = target["RequiresRecreation"]
             else:
                 change_target = change_reason = ""
                 requires_recreate = "No"
 
-            if requires_recreate == "Always" or requires_recreate == "Conditionally":
+            if requires_recreate in ("Always", "Conditionally"):
                 # If the resource requires recreation, mark the changeset as requiring recreation
                 # and add a warning to the change reason
                 recreate = True
                 requires_recreate = f"🚨{requires_recreate}🚨"
 
-            # Add the formatted details to the list of changes
-            changes.append(
-                [
-                    change["ResourceChange"]["Action"],
-                    requires_recreate,
-                    change["ResourceChange"]["ResourceType"],
-                    resource_id,
-                    change_target,
-                    change_reason,
-                ]
-            )
+            # Add the formatted details to the columns
+            actions.append(resource_change["Action"])
+            recreates.append(requires_recreate)
+            types.append(resource_change["ResourceType"])
+            ids.append(resource_id)
+            targets.append(change_target)
+            reasons.append(change_reason)
+
         # Sort by action
-        changes.sort(key=lambda x: x[0])
+        order = sorted(range(len(actions)), key=actions.__getitem__)
+
+        headings = [
+            "Action",
+            "Requires Recreation",
+            "Resource Type",
+            "Logical Resource Id",
+            "Change Target",
+            "Change Reason",
+        ]
 
-        # Add the headings for the table
-        changes.insert(
-            0,
+        # Generate the table. GFM doesn't need the columns to be padded to the same width
+        table = "\n".join(
             [
-                "Action",
-                "Requires Recreation",
-                "Resource Type",
-                "Logical Resource Id",
-                "Change Target",
-                "Change Reason",
-            ],
+                "| " + " | ".join(headings) + " |",
+                "|" + "|".join(["---"] * len(headings)) + "|",
+                *(
+                    f"| {actions[i]} | {recreates[i]} | {types[i]} | {ids[i]} | {targets[i]} | {reasons[i]} |"
+                    for i in order
+                ),
+            ]
         )
 
-        # Generate the table
-        table = Table(changes)
-
         # Generate the Github flavored markdown formatting
         return f"""
 <details>
 <summary>Changeset for stack <strong>{stack_name}</strong>{' (🚨 resources requires recreation 🚨)' if recreate else ''}</summary>
 
-{table.table}
+{table}
 
 </details>
 """